@@ -14,9 +14,9 @@ import cairo
 from time import time as time
 from time import strftime
 import sys
-from scipy.spatial import Delaunay,distance
+from scipy.spatial import Delaunay,cKDTree,QhullError
 from scipy.spatial.qhull import Delaunay
-from collections import defaultdict
+from numba import njit
 
 def timeit(method):
   def timed(*args, **kw):
@@ -28,6 +28,118 @@ def timeit(method):
   return timed
 
 
+@njit(cache=True)
+def relativeNeighbors(lXY,lsXY,cand):
+  """
+  jitted core of makeNodemap. each row of cand holds the candidate vein nodes
+  of a source node without repeats, unused entries are set to lXY.shape[0].
+
+  the maps are returned in CSR form:
+
+  - svIndices[svIndptr[j]:svIndptr[j+1]] = vein nodes of source node j
+  - vsIndices[vsIndptr[i]:vsIndptr[i+1]] = source nodes of vein node i
+
+  svDist and vsDist hold ||v-s|| for each entry of svIndices and vsIndices.
+  """
+
+  snum = lsXY.shape[0]
+  vnum = lXY.shape[0]
+  kmax = cand.shape[1]
+
+  ii     = np.empty(kmax,dtype=np.int64)
+  pts    = np.empty((kmax,2),dtype=lXY.dtype)
+  dvs    = np.empty(kmax,dtype=lXY.dtype)
+  dvv    = np.zeros((kmax,kmax),dtype=lXY.dtype)
+  rel    = np.empty((snum,kmax),dtype=np.int64)
+  reld   = np.empty((snum,kmax),dtype=lXY.dtype)
+  counts   = np.zeros(snum,dtype=np.int64)
+  vsCounts = np.zeros(vnum,dtype=np.int64)
+
+  ## pass 1: relative neighbors of each source node, and how many source
+  ## nodes each vein node is a relative neighbor of
+  for j in range(snum):
+
+    ## s -> potential neighboring points
+    k = 0
+    for v in cand[j]:
+      if v >= vnum:
+        continue
+      ii[k] = v
+      k    += 1
+
+    ## gather the candidates once, and do all distance calculations locally
+    for a in range(k):
+      pts[a,0] = lXY[ii[a],0]
+      pts[a,1] = lXY[ii[a],1]
+
+    ## ||v-s||
+    for a in range(k):
+      dx     = pts[a,0]-lsXY[j,0]
+      dy     = pts[a,1]-lsXY[j,1]
+      dvs[a] = np.sqrt(dx*dx+dy*dy)
+
+    ## ||u_i-v||, symmetric
+    for a in range(k):
+      for b in range(a+1,k):
+        dx       = pts[a,0]-pts[b,0]
+        dy       = pts[a,1]-pts[b,1]
+        dvv[a,b] = np.sqrt(dx*dx+dy*dy)
+        dvv[b,a] = dvv[a,b]
+
+    ## ||v-s|| < max{ ||u_i-s||, ||u_i-v|| } for all u_i
+    for a in range(k):
+      isrel = True
+      for b in range(k):
+        if b == a:
+          continue
+        if not dvs[a] < max( dvv[a,b],dvs[b] ):
+          isrel = False
+          break
+      if isrel:
+        rel[j,counts[j]]  = ii[a]
+        reld[j,counts[j]] = dvs[a]
+        counts[j]        += 1
+        vsCounts[ii[a]]  += 1
+
+  ## pass 2: offsets from the histograms, then scatter both maps. source
+  ## nodes end up in increasing order for each vein node.
+  svIndptr     = np.zeros(snum+1,dtype=np.int64)
+  svIndptr[1:] = np.cumsum(counts)
+  vsIndptr     = np.zeros(vnum+1,dtype=np.int64)
+  vsIndptr[1:] = np.cumsum(vsCounts)
+
+  svIndices = np.empty(svIndptr[snum],dtype=np.int64)
+  svDist    = np.empty(svIndptr[snum],dtype=lXY.dtype)
+  vsIndices = np.empty(vsIndptr[vnum],dtype=np.int64)
+  vsDist    = np.empty(vsIndptr[vnum],dtype=lXY.dtype)
+
+  cursor = vsIndptr[:-1].copy()
+  for j in range(snum):
+    for a in range(counts[j]):
+      i                        = rel[j,a]
+      svIndices[svIndptr[j]+a] = i
+      svDist[svIndptr[j]+a]    = reld[j,a]
+      vsIndices[cursor[i]]     = j
+      vsDist[cursor[i]]        = reld[j,a]
+      cursor[i]               += 1
+
+  return svIndptr,svIndices,svDist,vsIndptr,vsIndices,vsDist
+
+
+@njit(cache=True)
+def accumWidths(P,W,first,o):
+  """
+  simple vein width calculation. the width of each vein node from first on is
+  the size of its subtree. parents always come before their children, so a
+  single sweep from the last node is enough.
+  """
+
+  W[first:o] = 1.
+  for i in range(o-1,first-1,-1):
+    if P[i]>-1:
+      W[P[i]] += W[i]
+
+
 @timeit
 def main():
   """
@@ -40,34 +152,36 @@ def main():
   sin       = np.sin
   arctan2   = np.arctan2
   sqrt      = np.sqrt
-  random    = np.random.random
+  random    = np.random.default_rng().random
   pi        = np.pi
-  ft        = np.float64
+  ## single precision is plenty for a SIZE x SIZE canvas and halves the
+  ## memory traffic of the node arrays
+  ft        = np.float32
   bigint    = np.int64
-  ones      = np.ones
   zeros     = np.zeros
+  empty     = np.empty
   array     = np.array
   bool      = np.bool
   tile      = np.tile
   maximum   = np.maximum
-  colstack  = np.column_stack
-  rowstack  = np.row_stack
-  hstack    = np.hstack
   vstack    = np.vstack
   triag     = Delaunay
-  unique    = np.unique
-  positive  = lambda a: a[a>-1]
-  vectorize = np.vectorize
   logicNot  = np.logical_not
   square    = np.square
   linspace  = np.linspace
-  cdist     = distance.cdist
+  kdtree    = cKDTree
   eye       = np.eye
   transpose = np.transpose
   ceil      = np.ceil
   reshape   = np.reshape
-  npsum     = np.sum
   npall     = np.all
+  diff      = np.diff
+  nonzero   = np.flatnonzero
+  where     = np.where
+  arange    = np.arange
+  repeat    = np.repeat
+  cumsum    = np.cumsum
+  segsum    = np.add.reduceat
 
 
   ## GLOBAL-ISH CONSTANTS (SYSTEM RELATED)
@@ -92,6 +206,9 @@ def main():
   ALPHA  = 1.
   ## because five is right out
   FOUR   = 4
+  ## triangulate from scratch when the number of vein nodes has grown by this
+  ## factor since the last full triangulation
+  TRIGROW = 1.25
 
   ## GLOBAL-ISH CONSTANTS (PHYSICAL PROPERTIES)
   
@@ -100,7 +217,7 @@ def main():
   ## a source node dies when all approaching vein nodes are closer than this
   ## only killzone == veinNode == STP will cause consistently visible merging
   ## of branches in rendering.
-  killzone    = STP
+  killzone    = ft(STP)
   ## radius of vein nodes when rendered
   veinNode    = STP
   ## maximum number of vein nodes
@@ -133,22 +250,24 @@ def main():
 
   def stroke(x,y):
     """
-    draw dot for each (x,y)
+    draw dot for each (x,y). all dots are filled as one path.
     """
-    ctx.rectangle(x,y,1./SIZE,1./SIZE)
+    for xx,yy in zip(x.tolist(),y.tolist()):
+      ctx.rectangle(xx,yy,1./SIZE,1./SIZE)
     ctx.fill()
     return
-  vstroke = vectorize(stroke)
 
 
   def circ(x,y,cr):
     """
-    draw circle for each (x,y) with radius cr
+    draw circle for each (x,y) with radius cr. all circles are filled as one
+    path.
     """
-    ctx.arc(x,y,cr,0,2.*pi)
+    for xx,yy,rr in zip(x.tolist(),y.tolist(),cr.tolist()):
+      ctx.new_sub_path()
+      ctx.arc(xx,yy,rr,0,2.*pi)
     ctx.fill()
     return
-  vcirc = vectorize(circ)
 
 
   def draw(P,W,o,XY):
@@ -157,24 +276,23 @@ def main():
     """
 
     ## simple vein width calculation
-    for i in reversed(range(rootNodes,o)):
-      ii = P[i]
-      while ii>1:
-        W[ii]+=1.
-        ii = P[ii]
+    accumWidths(P,W,FOUR,o)
 
     wmax = W.max()
     W = sqrt(W/wmax)*rootW
     W[W<leafW] = leafW
 
-    ## show vein nodes
-    for i in reversed(range(rootNodes,o)):
-      dxy = XY[P[i],:]-XY[i,:]
-      a   = arctan2(dxy[1],dxy[0])
-      s   = linspace(0,1,GRAINS)*veinNode
-      xyp = XY[P[i],:] - array( cos(a),sin(a) )*s
+    ## show vein nodes, GRAINS dots along the segment to each parent
+    ii  = arange(o-1,FOUR+rootNodes-1,-1)
+    dxy = XY[P[ii],:]-XY[ii,:]
+    a   = arctan2(dxy[:,1],dxy[:,0])
+    s   = linspace(0,1,GRAINS)*veinNode
+    xp  = XY[P[ii],0:1] - cos(a)[:,None]*s
+    yp  = XY[P[ii],1:2] - sin(a)[:,None]*s
+
+    cr  = W[ii,None]/2. + zeros(GRAINS)
 
-      vcirc(xyp[0],xyp[1],[W[i]/2.]*GRAINS)
+    circ(xp.ravel(),yp.ravel(),cr.ravel())
 
   def tesselation(tri):
     """
@@ -197,15 +315,19 @@ def main():
     """
 
     ## random uniform points in a circle
-    t        = 2.*pi*random(n)
-    u        = random(n)+random(n)
+    ## all uniforms in one draw
+    uni      = random((3,n),dtype=ft)
+    t        = 2.*pi*uni[0,:]
+    u        = uni[1,:]+uni[2,:]
     r        = zeros(n,dtype=ft)
     mask     = u>1.
     xmask    = logicNot(mask)
     r[mask]  = 2.-u[mask]
     r[xmask] = u[xmask]
-    xyp      = colstack(( rr*r*cos(t),rr*r*sin(t) ))
-    dartsxy  = xyp + array( [xx,yy] )
+    xyp      = empty((n,2),dtype=ft)
+    xyp[:,0] = rr*r*cos(t)
+    xyp[:,1] = rr*r*sin(t)
+    dartsxy  = xyp + array( [xx,yy],dtype=ft )
 
     return dartsxy
 
@@ -219,115 +341,126 @@ def main():
     
     dartsxy = randomPointsInCircle(n)
 
-    jj = []
-
     ## remove new nodes that are too close to other 
-    ## new nodes
-    dists = cdist(dartsxy,dartsxy,'euclidean')
-    for j in range(n-1):
-      if all( dists[j,j+1:] > sourceDist ):
-        jj.append(j)
+    ## new nodes. of each colliding pair (j<k) the node k is dropped.
+    tree  = kdtree(dartsxy)
+    pairs = tree.query_pairs(r=sourceDist,output_type='ndarray')
+    drop  = zeros(n,dtype=bool)
+    drop[pairs[:,1]] = True
 
-    res = dartsxy[array(jj,dtype=bigint),:]
+    res = dartsxy[logicNot(drop),:]
     lenres = res.shape[0]
 
     return res,lenres
 
 
-  def throwMoreDarts(XY,sXY,o,n):
+  def throwMoreDarts(XY,sXYbuf,snum,o,n):
     """
     does the same as darts, but adds to existing points, making sure that
     distances from new nodes to source and vein nodes is greater than
-    sourceDist.
+    sourceDist. new nodes are appended to the source nodes in sXYbuf for
+    as long as there is room.
     """
 
-    dartsxy = randomPointsInCircle(n)
+    sXY = sXYbuf[:snum,:]
 
-    jj = []
-
-    dartsV = cdist(dartsxy,  XY[:o,:],'euclidean')
-    dartsS = cdist(dartsxy, sXY      ,'euclidean')
+    dartsxy = randomPointsInCircle(n)
 
     ## remove new nodes that are too close to other 
     ## new nodes or existing nodes
-    for j in range(n-1):
-
-      if all(dartsV[j,:]>sourceDist) and\
-         all(dartsS[j,:]>sourceDist):
-        jj.append(j)
-    
-    res = rowstack(( sXY,dartsxy[array(jj,dtype=bigint)] ))
-    lenres = res.shape[0]
+    dtree = kdtree(dartsxy)
+    pairs = dtree.query_pairs(r=sourceDist,output_type='ndarray')
+    drop  = zeros(n,dtype=bool)
+    drop[pairs[:,1]] = True
+
+    ## all(dist > sourceDist) over the existing nodes is the same as
+    ## nearest dist > sourceDist
+    tree    = kdtree(vstack(( XY[FOUR:o,:],sXY )))
+    dist,_  = tree.query(dartsxy)
+
+    jj = logicNot(drop) & (dist>sourceDist)
+    new = dartsxy[jj,:][:sXYbuf.shape[0]-snum,:]
+    lenres = snum+new.shape[0]
+    sXYbuf[snum:lenres,:] = new
+    res = sXYbuf[:lenres,:]
 
     return res,lenres
 
   
   #@timeit
-  def makeNodemap(snum,ldistVS,ltri,lXY,lsXY):
+  def findSimplex(ltri,lsXY):
+    """
+    index of the simplex of ltri that contains each source node
     """
-    map and inverse map of relative neighboring vein nodes of all source nodes
+
+    js = ltri.find_simplex(lsXY,tol=1e-10) 
+    ## the directed walk can miss in degenerate cases, brute force those
+    miss = js<0
+    if miss.any():
+      js[miss] = ltri.find_simplex(lsXY[miss,:],bruteforce=True,tol=1e-10)
+
+    return js
+
+
+  def makeNodemap(snum,js,p,nb,lXY,lsXY):
+    """
+    map and inverse map of relative neighboring vein nodes of all source nodes,
+    as CSR arrays (see relativeNeighbors)
     
-    - SVdict[source node indices] = list with indices of neighboring vein nodes
-    - VSdict[vein node indices] = list with indices of source nodes that have
-        this vein as a neighbor
+    - svIndptr,svIndices,svDist: source node -> indices of (and distances to)
+        neighboring vein nodes
+    - vsIndptr,vsIndices,vsDist: vein node -> indices of (and distances to)
+        source nodes that have this vein as a neighbor
 
     u_i is relative neighbor of s if for all u_i:
       ||v-s|| < max{ ||u_i-s||, ||u_i-v|| }
 
       we save time by only checking the vein nodes that belong to the
-      surounding simplices.
+      surounding simplices. js is the simplex of each source node, p the
+      vertices and nb the neighbors of each simplex.
     """
     
-    SVdict = {}
-    VSdict = defaultdict(list)
-    
-    # simplex -> vertices
-    p  = ltri.simplices
-    # s -> simplex
-    js = ltri.find_simplex(lsXY,bruteforce=True,tol=1e-10) 
     # s -> neighboring simplices including s
-    neigh = colstack((ltri.neighbors[js],js))
-    # s -> potential neighboring points
-    vv = [ unique( positive( p[ns,:]-FOUR ) ) \
-             for ns in neigh ]
-
-    uniqvv = unique( hstack(vv) )
-    vvdist = cdist( lXY[uniqvv,:],lXY[uniqvv,:],'euclidean')
-
-    lind = array(range(uniqvv.shape[0]),dtype=int)
-
-    for j,ii in enumerate(vv):
-      iin = ii.shape[0]
-      ## corresponds to
-      #    local = [np.where(uniqvv==i)[0][0] for i in ii]
-      #  that is, the local mapping of ii into uniqvv 
-      #  uniqvv must be sorted and all elements in ii must be in uniqvv
-      local = np.searchsorted(uniqvv, ii)
-      ##  = max { ||u_i-s||, ||u_i-v|| }
-      mas = maximum( vvdist[local,:][:,local], ldistVS[ii,j] )
-      
-      ## do all distance calculations locally:
-      #mas = maximum( cdist( lXY[ii,:],lXY[ii,:],'euclidean'),
-                       #ldistVS[ii,j] )
-
-      ##        ||v-s|| < mas
-      compare = reshape(ldistVS[ii,j],(iin,1)) < mas
-      mask    = npsum(compare,axis=1) == iin-1
-      maskn   = npsum(mask)
-
-      SVdict[j]=ii[mask]
-      [VSdict[i].append(j) for i in ii[mask]]
+    neigh = empty((js.shape[0],nb.shape[1]+1),dtype=nb.dtype)
+    neigh[:,:-1] = nb[js,:]
+    neigh[:,-1]  = js
+
+    # s -> potential neighboring points, unique for each s. missing
+    # neighbors, corners and repeats are set to vnum, past the last vein node.
+    # a missing neighbor is -1 in nb; indexing p with it would wrongly add
+    # the vertices of the last simplex as candidates.
+    vnum = lXY.shape[0]
+    cand = p[neigh,:]
+    cand = where( (cand>=FOUR) & (neigh>=0)[:,:,None],cand,vnum )
+    cand = cand.reshape(snum,-1)
+    cand.sort(axis=1)
+    cand[:,1:][ cand[:,1:]==cand[:,:-1] ] = vnum
+
+    return relativeNeighbors(lXY,lsXY,cand)
+
+  def triInit(o):
+    """
+    triangulation of the first o nodes, the four corners included
+    """
 
-    return VSdict,SVdict
+    ## QJ makes all added points appear in the triangulation
+    ## if they are duplicates they are added by adding a random small number to
+    ## the node.
+    return triag( XY[:o,:],
+                  incremental=True,
+                  qhull_options='QJ Qc')
 
   ### INITIALIZE
 
   XY       = zeros((int(vmax),2),dtype=ft)
   P        = zeros(int(vmax),dtype=bigint)-1
   W        = zeros(int(vmax),dtype=float)
+  ## source nodes live in the head of sXYbuf, see throwMoreDarts
+  sXYbuf   = zeros((2*sinit,2),dtype=ft)
   sXY,snum = darts(sinit)
+  sXYbuf[:snum,:] = sXY
+  sXY      = sXYbuf[:snum,:]
 
-  distVS   = None
   nodemap  = None
 
   ## (START) VEIN NODES
@@ -335,25 +468,19 @@ def main():
   ## triangulation needs at least four initial points
   ## in addition we need the initial triangulation 
   ## to contain all source nodes
-  ## remember that nodes in tri will be four indices higher than in X,Y
+  ## the four corners are kept in XY[:FOUR,:] so that nodes in tri have the
+  ## same indices as in XY. vein nodes start at FOUR.
 
-  o = rootNodes
-  xyinit          = zeros( (FOUR,2) )
-  xyinit[:FOUR,:] = array( [[0.,0.],[1.,0.],[1.,1.],[0.,1.]] )
+  XY[:FOUR,:] = array( [[0.,0.],[1.,0.],[1.,1.],[0.,1.]] )
+  o = FOUR+rootNodes
 
-
-  for i in range(rootNodes):
+  for i in range(FOUR,FOUR+rootNodes):
     t = random()*2.*pi
     xy = C  + array( [cos(t),sin(t)] )*RAD
     XY[i,:]          = xy
 
-  ## QJ makes all added points appear in the triangulation
-  ## if they are duplicates they are added by adding a random small number to
-  ## the node.
-  tri = triag( vstack(( xyinit,XY[:o,:]  )),
-               incremental=True,
-               qhull_options='QJ Qc')
-  triadd = tri.add_points
+  tri    = triInit(o)
+  triNum = o
 
   ### MAIN LOOP
 
@@ -365,51 +492,77 @@ def main():
   try:
     while True:
 
-      ## distance: vein nodes -> source nodes
-      distVS = cdist(XY[:o,:],sXY,'euclidean')
-      
       ## this is where the magic might happen
-      VSdict,SVdict = makeNodemap(snum,distVS,tri,XY,sXY)
-
-      ## grow new vein nodes
+      ## the triangulation as plain arrays, looked up once per iteration
+      triSimplices = tri.simplices
+      triNeighbors = tri.neighbors
+      js           = findSimplex(tri,sXY)
+
+      svIndptr,svIndices,svDist,vsIndptr,vsIndices,vsDist = \
+          makeNodemap(snum,js,triSimplices,triNeighbors,XY[:o,:],sXY)
+
+      ## vein nodes that have source nodes, none of them within killzone
+      vsOwner = repeat(arange(o),diff(vsIndptr))
+      grow    = zeros(o,dtype=bool)
+      grow[vsOwner] = True
+      grow[vsOwner[vsDist<=killzone]] = False
+
+      ## source nodes with all their vein nodes within killzone are dead
+      svOwner = repeat(arange(snum),diff(svIndptr))
+      mask    = zeros(snum,dtype=bool)
+      mask[svOwner[svDist>killzone]] = True
+
+      ## grow new vein nodes, all at once. each steps veinNode along the
+      ## summed direction to its source nodes
       oo = o
-      for i,jj in VSdict.items():
-        mask = distVS[i,jj]<=killzone
-        if jj and not any(mask):
-          txy      = npsum( XY[i,:] -sXY[jj,:] ,axis=0)
-          a        = arctan2( txy[1],txy[0] )
-          xy       = array( [cos(a),sin(a)] )*veinNode
-          XY[o,:]  = XY[i,:] - xy 
-          P[o]     = i
-          o       += 1
-        
-      ## mask out dead source nodes
-      mask = ones(snum,dtype=bool)
-      for j,ii in SVdict.items():
-        if all(distVS[ii,j]<=killzone):
-          mask[j]      = False
-          mn           = ii.shape[0]
-          txy          = XY[ii,:]-sXY[j,:]
-          a            = arctan2( txy[:,1],txy[:,0] )
-          xy           = colstack(( cos(a),sin(a) ))*veinNode
-          XY[o:o+mn,:] = XY[ii,:] + xy 
-          P[ o:o+mn  ] = ii
-          o           += mn
-
-      ## add new points to triangulation
-      #triadd(XY[oo:o,:])
-      
+      gi = nonzero(grow)
+      gn = gi.shape[0]
+      if gn:
+        sel   = grow[vsOwner]
+        cnt   = diff(vsIndptr)[gi]
+        txy   = XY[vsOwner[sel],:]-sXY[vsIndices[sel],:]
+        txy   = segsum( txy,cumsum(cnt)-cnt,axis=0 )
+        a     = arctan2( txy[:,1],txy[:,0] )
+        XY[o:o+gn,0] = XY[gi,0] - cos(a)*veinNode
+        XY[o:o+gn,1] = XY[gi,1] - sin(a)*veinNode
+        P[ o:o+gn  ] = gi
+        o           += gn
+
+      ## one new node from each vein node of a dead source, pointing away
+      ## from it, all at once
+      sel = logicNot(mask)[svOwner]
+      ii  = svIndices[sel]
+      mn  = ii.shape[0]
+      txy = XY[ii,:]-sXY[svOwner[sel],:]
+      a   = arctan2( txy[:,1],txy[:,0] )
+      XY[o:o+mn,0] = XY[ii,0] + cos(a)*veinNode
+      XY[o:o+mn,1] = XY[ii,1] + sin(a)*veinNode
+      P[ o:o+mn  ] = ii
+      o           += mn
+
+      ## add new points to triangulation. incremental insertion gets slower
+      ## the more points qhull has added, so every now and then (and for the
+      ## rare degenerate configurations) we start over from scratch.
       tri_time_a = time()
-      del(tri)
-      tri = triag( vstack(( xyinit,XY[:o,:]  )),qhull_options='Pp')
+      rebuild = o>TRIGROW*triNum
+      if not rebuild and o>oo:
+        try:
+          tri.add_points(XY[oo:o,:])
+        except QhullError:
+          rebuild = True
+      if rebuild:
+        tri.close()
+        tri    = triInit(o)
+        triNum = o
       tri_time += time()-tri_time_a
       
 
       ## remove dead soure nodes
-      sXY  = sXY[mask,:]
-      snum = sXY.shape[0]
+      snum = int(mask.sum())
+      sXYbuf[:snum,:] = sXY[mask,:]
+      sXY  = sXYbuf[:snum,:]
 
-      #sXY,snum = throwMoreDarts(XY,sXY,o,sadd)
+      #sXY,snum = throwMoreDarts(XY,sXYbuf,snum,o,sadd)
 
       #if snum<3 or itt > 299:
       if snum<3: